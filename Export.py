@@ -0,0 +1,270 @@
+import os, time, datetime
+import numpy as np
+import pandas as pd
+from queue import Queue, Empty
+from collections import deque
+from threading import Thread
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+class Exporter():
+    """
+    @info:
+    Streams the data kept by a Client to chunked columnar files in a background thread, so the
+    DataFrames never have to be converted and saved in full. Only new rows are written:
+        - ticks  : every ticker update as it is processed
+        - candles: every candle once it is closed by a ticker of the following period
+        - book   : the best depth levels of each order book every snapshot_every seconds
+    Rows are collected in memory and appended to the current file of their stream as one chunk
+    every chunk_rows rows or flush_every seconds. Files are rotated when they are older than
+    rotate_seconds or larger than rotate_bytes, also when their stream is idle. Rows with a value that
+    can not be converted to the type of its column are not written, the last 1000 of them are kept in
+    self.rejected and self.rejected_count counts all of them.
+
+    Formats: - parquet: one row group per chunk. Requires pyarrow. The footer of a parquet file is only written when the
+                        file is rotated or the exporter is stopped, so the open file is unreadable if the process crashes and
+                        up to rotate_seconds of data is lost. Keep rotate_seconds short, or use the numpy format
+             - numpy  : every chunk is saved with numpy.save as the column names followed by one array per column.
+                        Every chunk completely written before a crash can be read, read() skips a truncated last chunk
+
+    @use:
+    ws = Client(production=True, ticker=[ 'BTC-USD' ], level2=[ 'BTC-USD' ], ohlc=[ [ 'BTC-USD','1min' ] ])
+    ws.open()
+    exporter = Exporter(ws, path='data', format='parquet', depth=10, rotate_seconds=600)
+    exporter.start()
+    ...
+    exporter.stop()
+    read('data/ticks/BTC-USD-20181012T101500-0.parquet')
+
+    @params:
+    client         : instance of the Client class
+    path           : Directory the files are written to. One sub directory per stream (ticks, candles, book)
+    format         : 'parquet' or 'numpy'. Defaults to parquet when pyarrow is installed
+    depth          : Number of price levels of each side saved with every book snapshot
+    snapshot_every : Seconds between book snapshots. None disables book snapshots
+    chunk_rows     : Rows collected before a chunk is written
+    flush_every    : Seconds after which a chunk is written even if it holds less than chunk_rows rows
+    rotate_seconds : Seconds after which a new file is started. None disables time based rotation
+    rotate_bytes   : Size in bytes after which a new file is started. None disables size based rotation
+    """
+    COLUMNS = {
+        'ticks'  : [ ('time','f8'), ('product_id','U16'), ('price','f8'), ('last_size','f8'), ('best_bid','f8'), ('best_ask','f8'),
+                     ('side','U4'), ('sequence','i8'), ('trade_id','i8') ],
+        'candles': [ ('product_id','U16'), ('increment','U8'), ('time','f8'), ('low','f8'), ('high','f8'), ('open','f8'), ('close','f8'), ('volume','f8') ],
+        'book'   : [ ('time','f8'), ('product_id','U16'), ('side','U4'), ('level','i8'), ('price','f8'), ('size','f8') ]
+    }
+
+    def __init__(self, client, path='data', format=None, depth=10, snapshot_every=1, chunk_rows=10000, flush_every=5,
+                 rotate_seconds=600, rotate_bytes=128 * 1024 * 1024):
+        if format is None:
+            format = 'parquet' if pa else 'numpy'
+        if format not in ['parquet','numpy']:
+            raise Exception("Unknown format {}. Use 'parquet' or 'numpy'".format(format))
+        if format == 'parquet' and pa is None:
+            raise Exception('The parquet format requires pyarrow. Install pyarrow or use the numpy format')
+
+        self.client         = client
+        self.path           = path
+        self.format         = format
+        self.depth          = depth
+        self.snapshot_every = snapshot_every
+        self.chunk_rows     = chunk_rows
+        self.flush_every    = flush_every
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes   = rotate_bytes
+
+        self.queue          = Queue()
+        self.buffers        = {}
+        self.writers        = {}
+        self.thread         = None
+        self.running        = False
+        self.rows_written   = 0
+        self.rejected       = deque(maxlen=1000)
+        self.rejected_count = 0
+
+    # ==============================================================================
+    # The following methods are called by the Client while processing messages.
+    # They only queue the row, the conversion and writing happens in the export thread
+    # ==============================================================================
+
+    def tick(self, ticker):
+        self.queue.put(( 'ticks', ticker['product_id'], (
+            ticker['time'], ticker['product_id'], ticker['price'], ticker['last_size'], ticker['best_bid'], ticker['best_ask'],
+            ticker.get('side', ''), ticker.get('sequence', 0), ticker.get('trade_id', 0) ) ))
+
+    def candle(self, product, increment, candle):
+        self.queue.put(( 'candles', '{}-{}'.format(product, increment), (
+            product, increment, candle['time'], candle['low'], candle['high'], candle['open'], candle['close'], candle['volume'] ) ))
+
+    # ==============================================================================
+    # Controls starting and stopping the export
+    # ==============================================================================
+
+    def start(self):
+        """Starts the export thread and attaches the exporter to the client"""
+        self.running     = True
+        self.thread      = Thread(target=self.run, name='Exporter', daemon=True)
+        self.thread.start()
+        self.client.exporter = self
+
+    def stop(self):
+        """Detaches the exporter from the client, writes the remaining rows and closes the files"""
+        if self.client.exporter is self:
+            self.client.exporter = None
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        next_snapshot = next_check = time.time()
+        while True:
+            try:
+                stream, key, row = self.queue.get(timeout=0.1)
+                self.buffer(stream, key).append(row)
+            except Empty:
+                if not self.running:
+                    break
+
+            now = time.time()
+            if now < next_check:
+                continue
+            next_check = now + 0.1
+            try:
+                if self.snapshot_every and now >= next_snapshot:
+                    self.snapshot(now)
+                    next_snapshot = now + self.snapshot_every
+                for (stream, key), buffer in self.buffers.items():
+                    if len(buffer['rows']) >= self.chunk_rows or (buffer['rows'] and now - buffer['flushed'] >= self.flush_every):
+                        self.flush(stream, key)
+                # close expired files of idle streams too, a parquet file is only readable once it is closed
+                for stream_key, writer in list(self.writers.items()):
+                    if writer.expired(self.rotate_seconds, self.rotate_bytes):
+                        writer.close()
+                        del self.writers[stream_key]
+            except Exception as e:
+                print("{}: Export error: {}".format(datetime.datetime.now(), e))
+
+        for stream, key in list(self.buffers):
+            self.flush(stream, key)
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+
+    # ==============================================================================
+    # The following methods run in the export thread
+    # ==============================================================================
+
+    def buffer(self, stream, key):
+        if (stream, key) not in self.buffers:
+            self.buffers[(stream, key)] = { 'rows': [], 'flushed': time.time() }
+        return self.buffers[(stream, key)]['rows']
+
+    def snapshot(self, now):
+        """Buffers the best levels of every order book managed by the client"""
+        for product, data in list(self.client.data.items()):
+            if product != 'user' and 'orderbook' in data and data['orderbook'].snapshot_received:
+                rows = self.buffer('book', product)
+                for level in data['orderbook'].top(self.depth).itertuples(index=False):
+                    rows.append(( now, product, level.side, level.level, level.price, level.size ))
+
+    def columns(self, stream, rows):
+        return [ (name, np.array(values, dtype=dtype)) for (name, dtype), values in zip(self.COLUMNS[stream], zip(*rows)) ]
+
+    def flush(self, stream, key):
+        buffer = self.buffers[(stream, key)]
+        rows   = buffer['rows']
+        try:
+            columns = self.columns(stream, rows) if rows else None
+        except (ValueError, TypeError):
+            # find the rows that can not be converted and set them aside so the rest of the chunk is still written
+            converted = []
+            for row in rows:
+                try:
+                    self.columns(stream, [row])
+                    converted.append(row)
+                except (ValueError, TypeError):
+                    self.rejected.append(( stream, key, row ))
+                    self.rejected_count += 1
+            print("{}: Export set aside {} {} rows of {} that could not be converted. See Exporter.rejected".format(
+                datetime.datetime.now(), len(rows) - len(converted), stream, key))
+            rows    = converted
+            columns = self.columns(stream, rows) if rows else None
+        buffer['rows'], buffer['flushed'] = [], time.time()
+        if not rows:
+            return
+
+        writer = self.writers.get((stream, key))
+        if writer and writer.expired(self.rotate_seconds, self.rotate_bytes):
+            writer.close()
+            writer = None
+        if writer is None:
+            writer = ChunkWriter(os.path.join(self.path, stream), key, self.format)
+            self.writers[(stream, key)] = writer
+        writer.write(columns)
+        self.rows_written += len(rows)
+
+
+class ChunkWriter():
+    """Appends column chunks to a single parquet or numpy file"""
+
+    def __init__(self, directory, key, format):
+        os.makedirs(directory, exist_ok=True)
+        stamp         = datetime.datetime.now().strftime('%Y%m%dT%H%M%S')
+        extension     = 'parquet' if format == 'parquet' else 'npy'
+        number        = 0
+        while os.path.exists(os.path.join(directory, '{}-{}-{}.{}'.format(key, stamp, number, extension))):
+            number   += 1
+        self.filename = os.path.join(directory, '{}-{}-{}.{}'.format(key, stamp, number, extension))
+        self.format   = format
+        self.created  = time.time()
+        self.file     = None
+        self.writer   = None
+
+    def write(self, columns):
+        if self.format == 'parquet':
+            table = pa.table({ name: pa.array(values.tolist() if values.dtype.kind == 'U' else values) for name, values in columns })
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.filename, table.schema)
+            self.writer.write_table(table)
+        else:
+            if self.file is None:
+                self.file = open(self.filename, 'ab')
+            np.save(self.file, np.array([ name for name, _ in columns ]))
+            for _, values in columns:
+                np.save(self.file, values)
+            self.file.flush()
+
+    def size(self):
+        return os.path.getsize(self.filename) if os.path.exists(self.filename) else 0
+
+    def expired(self, rotate_seconds, rotate_bytes):
+        return bool((rotate_seconds and time.time() - self.created >= rotate_seconds) or
+                    (rotate_bytes and self.size() >= rotate_bytes))
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def read(filename):
+    """Loads a file written by the Exporter into a DataFrame. A numpy chunk truncated by a crash is skipped"""
+    if filename.endswith('.parquet'):
+        return pd.read_parquet(filename)
+    chunks = []
+    with open(filename, 'rb') as f:
+        while f.tell() < os.fstat(f.fileno()).st_size:
+            try:
+                names = np.load(f)
+                chunks.append(pd.DataFrame({ name: np.load(f) for name in names }))
+            except (ValueError, EOFError, OSError):
+                print("{}: skipped the truncated last chunk of {}".format(datetime.datetime.now(), filename))
+                break
+    return pd.concat(chunks, ignore_index=True) if chunks else pd.DataFrame([])
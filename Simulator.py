@@ -0,0 +1,631 @@
+import time, base64, hashlib, json, datetime, socket, struct, math, multiprocessing
+import pandas as pd
+from random import Random
+from threading import Thread, Lock
+from collections import deque
+from Websocket import Client
+
+class FeedServer():
+    """
+    @info:
+    Local websocket server that speaks the subset of the Coinbase Pro feed protocol consumed by the
+    Client class (subscribe, subscriptions, heartbeat, ticker, snapshot, l2update and the user channel
+    messages received, open, match and done). It is used to stress test the Client without connecting
+    to the exchange. Traffic is either synthetic (seeded, reproducible) or replayed from a recording.
+
+    @use:
+    server = FeedServer(products=[ 'BTC-USD','ETH-USD' ], rate=500, seed=1)
+    server.start(process=True)
+    ws = Client(ticker=[ 'BTC-USD' ], level2=[ 'BTC-USD' ], user=True, url=server.url)
+    ws.open()
+    ...
+    ws.close()
+    server.stop()
+
+    @params:
+    host            : Interface the server listens on
+    port            : Port the server listens on. 0 picks a free port, see self.url
+    products        : Products streamed to connections that do not list any product ids (user channel)
+    rate            : Messages per second sent to each connection, heartbeats excluded. Can be changed while running with set_rate()
+    seed            : Seed for the synthetic traffic and the injected faults. Connection n uses seed + n
+    recorded        : Path to a file with one raw websocket message (json) per line, or a list of messages.
+                      When given the messages are replayed in a loop instead of generating synthetic traffic
+    disconnect_every: Seconds after which the server drops a connection without a close frame. None disables it
+    gap_probability : Probability of dropping a ticker or l2update message before it is sent, which leaves a gap in the sequence numbers.
+                      User channel messages are never dropped, an order missing its received message would be retried by the Client forever
+    burst_every     : Seconds between bursts. None disables bursts
+    burst_size      : Number of extra messages sent back to back at every burst
+    weights         : Relative share of the traffic for each channel. Example { 'ticker': 1, 'level2': 4, 'user': 0.1 }
+
+    @variables:
+    sent        : Total messages sent across all connections, heartbeats excluded
+    connections : Number of connections served since start()
+
+    rate, sent and connections are shared with the server process when the server is started with start(process=True)
+    """
+
+    WEIGHTS = { 'ticker': 1, 'level2': 4, 'user': 0.05 }
+
+    def __init__(self, host='127.0.0.1', port=0, products=['BTC-USD'], rate=100, seed=None, recorded=None,
+                 disconnect_every=None, gap_probability=0.0, burst_every=None, burst_size=0, weights=None):
+        self.host             = host
+        self.port             = port
+        self.products         = products
+        self.seed             = seed
+        self.recorded         = recorded
+        self.disconnect_every = disconnect_every
+        self.gap_probability  = gap_probability
+        self.burst_every      = burst_every
+        self.burst_size       = burst_size
+        self.weights          = weights if weights else self.WEIGHTS
+
+        self._rate            = multiprocessing.Value('d', rate)
+        self._sent            = multiprocessing.Value('q', 0)
+        self._connections     = multiprocessing.Value('i', 0)
+        self._port            = multiprocessing.Value('i', port)
+        self._stop            = multiprocessing.Event()
+        self.running          = False
+        self.sock             = None
+        self.accept_thread    = None
+        self.process          = None
+
+    @property
+    def url(self):
+        return 'ws://{}:{}'.format(self.host, self.port)
+
+    @property
+    def rate(self):
+        return self._rate.value
+
+    @property
+    def sent(self):
+        return self._sent.value
+
+    @property
+    def connections(self):
+        return self._connections.value
+
+    def set_rate(self, rate):
+        """Changes the number of messages per second sent to every open connection"""
+        self._rate.value = rate
+
+    # ==============================================================================
+    # Controls starting and stopping the server
+    # ==============================================================================
+
+    def start(self, process=False):
+        """
+        Binds the listening socket and starts accepting connections in a background thread. With process=True the
+        server runs in a separate process, so generating the traffic does not compete with the Client for the GIL
+        """
+        if process:
+            ready   = multiprocessing.Event()
+            process = multiprocessing.Process(target=self.run_process, args=(ready,), name='Feed server', daemon=True)
+            process.start()
+            if not ready.wait(30):
+                process.terminate()
+                raise Exception('The feed server process did not start')
+            self.port    = self._port.value
+            self.process = process
+            return
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(16)
+        self.sock.settimeout(0.5)
+        self.port          = self.sock.getsockname()[1]
+        self._port.value   = self.port
+        self.running       = True
+        self.accept_thread = Thread(target=self.accept, name='Feed server', daemon=True)
+        self.accept_thread.start()
+        print("Feed server listening on {}".format(self.url))
+
+    def run_process(self, ready):
+        self.start()
+        ready.set()
+        self._stop.wait()
+        self.stop()
+
+    def stop(self):
+        if self.process:
+            self._stop.set()
+            self.process.join()
+            self.process = None
+            return
+        self.running = False
+        if self.accept_thread:
+            self.accept_thread.join()
+            self.accept_thread = None
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def accept(self):
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self._connections.get_lock():
+                self._connections.value += 1
+                number = self._connections.value
+            Thread(target=self.serve, args=(conn, number), name='Feed connection {}'.format(number), daemon=True).start()
+
+    # ==============================================================================
+    # The following methods handle a single connection
+    # ==============================================================================
+
+    def serve(self, conn, number):
+        connection = Connection(conn)
+        try:
+            if not connection.handshake():
+                return
+            subscription = connection.wait_for_subscription()
+            if subscription is None:
+                return
+            channels, products = self.parse_subscription(subscription)
+            connection.send({ 'type': 'subscriptions', 'channels': [ { 'name': name, 'product_ids': products[name] } for name in channels ] })
+            connection.listen()
+
+            seed = None if self.seed is None else self.seed + number
+            rng  = Random(seed)
+            if self.recorded is not None:
+                feed = RecordedFeed(self.recorded)
+            else:
+                feed = SyntheticFeed(sorted(set(sum(products.values(), []))), seed=seed)
+                for product in products.get('level2', []):
+                    connection.send(feed.snapshot(product))
+            self.stream(connection, feed, channels, products, rng)
+        except (OSError, ValueError):
+            pass # the client went away, nothing left to do with this connection
+        finally:
+            connection.close()
+
+    def parse_subscription(self, subscription):
+        """Returns the subscribed channel names and the product ids of each channel"""
+        default  = subscription.get('product_ids') or self.products
+        channels, products = [], {}
+        for channel in subscription.get('channels', []):
+            if isinstance(channel, str):
+                name, product_ids = channel, default
+            else:
+                name, product_ids = channel['name'], channel.get('product_ids') or default
+            channels.append(name)
+            products[name] = list(product_ids)
+        return channels, products
+
+    def stream(self, connection, feed, channels, products, rng):
+        streamed  = [ channel for channel in ['ticker','level2','user'] if channel in channels ]
+        weights   = [ self.weights.get(channel, 0) for channel in streamed ]
+        active    = self.recorded is not None or sum(weights) > 0
+        now       = time.time()
+        last      = now
+        credit    = 0.0
+        heartbeat = now
+        burst     = now + self.burst_every if self.burst_every else None
+        drop      = now + self.disconnect_every if self.disconnect_every else None
+
+        while self.running and connection.open:
+            now     = time.time()
+            credit  = min(credit + (now - last) * self.rate, max(self.rate, 1))
+            last    = now
+            count   = int(credit)
+            credit -= count
+            if burst and now >= burst:
+                count += self.burst_size
+                burst += self.burst_every
+
+            sent    = 0
+            for _ in range(count if active else 0):
+                if self.recorded is not None:
+                    message = feed.message()
+                else:
+                    channel = rng.choices(streamed, weights)[0]
+                    message = feed.message(channel, rng.choice(products[channel]))
+                if self.gap_probability and message.get('type') in ['ticker','l2update'] and rng.random() < self.gap_probability:
+                    continue
+                connection.send(message)
+                sent += 1
+            if sent:
+                with self._sent.get_lock():
+                    self._sent.value += sent
+
+            if 'heartbeat' in channels and now >= heartbeat:
+                for product in products['heartbeat']:
+                    connection.send(feed.heartbeat(product))
+                heartbeat += 1
+
+            if drop and now >= drop:
+                print("{}: Feed server dropping connection".format(datetime.datetime.now()))
+                break
+            time.sleep(0.01)
+
+
+class Connection():
+    """Minimal server side implementation of the websocket protocol (RFC 6455) over a plain socket"""
+    GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+    def __init__(self, conn):
+        self.conn  = conn
+        self.open  = False
+        self.lock  = Lock()
+
+    def read(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.conn.recv(n - len(data))
+            if not chunk:
+                raise ValueError('connection closed')
+            data += chunk
+        return data
+
+    def handshake(self):
+        request = b''
+        while b'\r\n\r\n' not in request:
+            chunk = self.conn.recv(4096)
+            if not chunk:
+                return False
+            request += chunk
+        headers = {}
+        for line in request.decode('latin-1').split('\r\n')[1:]:
+            if ':' in line:
+                key, value = line.split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+        if 'sec-websocket-key' not in headers:
+            return False
+        accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + self.GUID).encode('ascii')).digest()).decode('ascii')
+        self.conn.sendall(('HTTP/1.1 101 Switching Protocols\r\n'
+                           'Upgrade: websocket\r\n'
+                           'Connection: Upgrade\r\n'
+                           'Sec-WebSocket-Accept: {}\r\n\r\n').format(accept).encode('ascii'))
+        self.open = True
+        return True
+
+    def frame(self):
+        """Reads a single frame sent by the client. Returns the opcode and the unmasked payload"""
+        first, second = self.read(2)
+        opcode, length = first & 0x0f, second & 0x7f
+        if   length == 126: length = struct.unpack('!H', self.read(2))[0]
+        elif length == 127: length = struct.unpack('!Q', self.read(8))[0]
+        mask    = self.read(4) if second & 0x80 else b'\x00\x00\x00\x00'
+        payload = bytes( byte ^ mask[i % 4] for i, byte in enumerate(self.read(length)) )
+        return opcode, payload
+
+    def write(self, opcode, payload):
+        length = len(payload)
+        if   length < 126:   header = struct.pack('!BB', 0x80 | opcode, length)
+        elif length < 65536: header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+        else:                header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+        with self.lock:
+            self.conn.sendall(header + payload)
+
+    def send(self, message):
+        self.write(0x1, json.dumps(message).encode('utf-8'))
+
+    def wait_for_subscription(self):
+        while self.open:
+            opcode, payload = self.frame()
+            if opcode == 0x8:
+                return None
+            elif opcode == 0x9:
+                self.write(0xA, payload)
+            elif opcode == 0x1:
+                message = json.loads(payload.decode('utf-8'))
+                if message.get('type') == 'subscribe':
+                    return message
+
+    def listen(self):
+        """Answers pings and close frames from the client in a background thread"""
+        def _listen():
+            try:
+                while self.open:
+                    opcode, payload = self.frame()
+                    if opcode == 0x8:
+                        self.write(0x8, payload[:2])
+                        self.open = False
+                    elif opcode == 0x9:
+                        self.write(0xA, payload)
+            except (OSError, ValueError):
+                self.open = False
+        Thread(target=_listen, name='Feed connection listener', daemon=True).start()
+
+    def close(self):
+        self.open = False
+        try:
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class SyntheticFeed():
+    """
+    @info:
+    Generates reproducible ticker, level2 and user channel messages for a list of products.
+    Prices follow a random walk around a starting price and the user channel produces complete
+    order lifecycles: received, open, one or more matches and done.
+    """
+    PRICES = { 'BTC-USD': 6400.0, 'ETH-USD': 220.0, 'LTC-USD': 55.0, 'BCH-USD': 450.0, 'ETC-USD': 10.0, 'ZRX-USD': 0.8,
+               'ETH-BTC': 0.034, 'LTC-BTC': 0.0086, 'BCH-BTC': 0.07, 'ETC-BTC': 0.0016, 'ZRX-BTC': 0.00012 }
+
+    def __init__(self, products, seed=None):
+        self.rng       = Random(seed)
+        self.products  = products
+        self.mid       = { product: self.PRICES.get(product, 100.0) for product in products }
+        self.ticks     = { product: max(round(self.mid[product] * 0.00001, 8), 0.00000001) for product in products }
+        self.books     = { product: { 'buy': {}, 'sell': {} } for product in products } # price level (price / tick): size
+        self.sequence  = { product: self.rng.randint(1, 10**6) * 1000 for product in products }
+        self.trade_id  = self.rng.randint(1, 10**6)
+        self.user_id   = 'simulated-user'
+        self.pending   = deque()
+
+    def now(self):
+        return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+    def tick(self, product):
+        return self.ticks[product]
+
+    def price(self, product, level):
+        return '{:.8f}'.format(level * self.tick(product))
+
+    def best(self, product):
+        """Returns the highest bid level and the lowest ask level strictly inside the mid price"""
+        mid = self.mid[product] / self.tick(product)
+        return math.ceil(mid) - 1, math.floor(mid) + 1
+
+    def next_sequence(self, product):
+        self.sequence[product] += 1
+        return self.sequence[product]
+
+    def walk(self, product):
+        self.mid[product] = max(self.mid[product] + self.rng.gauss(0, 2) * self.tick(product), self.tick(product))
+        return self.mid[product]
+
+    def message(self, channel, product):
+        if   channel == 'ticker': return self.ticker(product)
+        elif channel == 'level2': return self.l2update(product)
+        elif channel == 'user':   return self.user(product)
+
+    def heartbeat(self, product):
+        return { 'type': 'heartbeat', 'sequence': self.sequence[product], 'last_trade_id': self.trade_id, 'product_id': product, 'time': self.now() }
+
+    def ticker(self, product):
+        price  = self.walk(product)
+        spread = self.tick(product)
+        self.trade_id += 1
+        return {
+            'type'      : 'ticker',
+            'sequence'  : self.next_sequence(product),
+            'product_id': product,
+            'price'     : '{:.8f}'.format(price),
+            'open_24h'  : '{:.8f}'.format(self.PRICES.get(product, 100.0)),
+            'volume_24h': '{:.8f}'.format(self.rng.uniform(1000, 20000)),
+            'low_24h'   : '{:.8f}'.format(price * 0.97),
+            'high_24h'  : '{:.8f}'.format(price * 1.03),
+            'volume_30d': '{:.8f}'.format(self.rng.uniform(100000, 400000)),
+            'best_bid'  : '{:.8f}'.format(price - spread),
+            'best_ask'  : '{:.8f}'.format(price + spread),
+            'side'      : self.rng.choice(['buy','sell']),
+            'time'      : self.now(),
+            'trade_id'  : self.trade_id,
+            'last_size' : '{:.8f}'.format(self.rng.expovariate(10))
+        }
+
+    def snapshot(self, product, depth=50):
+        bid, ask = self.best(product)
+        book     = self.books[product]
+        book['buy']  = { bid - level: self.rng.expovariate(1) for level in range(depth) }
+        book['sell'] = { ask + level: self.rng.expovariate(1) for level in range(depth) }
+        return {
+            'type'      : 'snapshot',
+            'product_id': product,
+            'bids'      : [ [ self.price(product, level), '{:.8f}'.format(size) ] for level, size in sorted(book['buy'].items(), reverse=True) ],
+            'asks'      : [ [ self.price(product, level), '{:.8f}'.format(size) ] for level, size in sorted(book['sell'].items()) ]
+        }
+
+    def l2update(self, product, depth=50):
+        self.walk(product)
+        bid, ask = self.best(product)
+        book     = self.books[product]
+        # levels crossed by the mid price, or left more than 2 * depth levels behind, are removed so the book never crosses
+        removed  = [ ('buy',  level) for level in book['buy']  if level > bid or level < bid - 2 * depth ]
+        removed += [ ('sell', level) for level in book['sell'] if level < ask or level > ask + 2 * depth ]
+        changes  = []
+        for side, level in removed:
+            del book[side][level]
+            changes.append([ side, self.price(product, level), '0.00000000' ])
+
+        side  = self.rng.choice(['buy','sell'])
+        level = bid - self.rng.randint(0, depth - 1) if side == 'buy' else ask + self.rng.randint(0, depth - 1)
+        size  = 0.0 if self.rng.random() < 0.3 else self.rng.expovariate(1)
+        if size:
+            book[side][level] = size
+        else:
+            book[side].pop(level, None)
+        changes.append([ side, self.price(product, level), '{:.8f}'.format(size) ])
+        return { 'type': 'l2update', 'product_id': product, 'time': self.now(), 'changes': changes }
+
+    def user(self, product):
+        if not self.pending:
+            self.lifecycle(product)
+        message = self.pending.popleft()
+        message['sequence'] = self.next_sequence(message['product_id'])
+        message['time']     = self.now()
+        return message
+
+    def lifecycle(self, product):
+        """Queues the messages of a complete order lifecycle for the given product"""
+        order_id = '{:032x}'.format(self.rng.getrandbits(128))
+        side     = self.rng.choice(['buy','sell'])
+        price    = self.walk(product)
+        size     = round(self.rng.uniform(0.01, 2), 8)
+        order    = { 'product_id': product, 'order_id': order_id, 'side': side, 'price': '{:.8f}'.format(price) }
+        self.pending.append(dict(order, type='received', size='{:.8f}'.format(size), order_type='limit'))
+        self.pending.append(dict(order, type='open', remaining_size='{:.8f}'.format(size)))
+
+        remaining = size
+        for _ in range(self.rng.randint(0, 3)):
+            filled     = round(min(remaining, self.rng.uniform(0.001, size)), 8)
+            remaining  = round(remaining - filled, 8)
+            maker      = self.rng.random() < 0.5
+            other      = '{:032x}'.format(self.rng.getrandbits(128))
+            self.trade_id += 1
+            self.pending.append({
+                'type'          : 'match',
+                'trade_id'      : self.trade_id,
+                'maker_order_id': order_id if maker else other,
+                'taker_order_id': other if maker else order_id,
+                'product_id'    : product,
+                'size'          : '{:.8f}'.format(filled),
+                'price'         : order['price'],
+                'side'          : side if maker else ('sell' if side == 'buy' else 'buy'), # the side of the maker order
+                'user_id'       : self.user_id,
+                'maker_user_id' : self.user_id if maker else 'simulated-counterparty',
+                # the exchange sends the fee rate of the user's side of the trade
+                **({ 'maker_fee_rate': '0.0015' } if maker else { 'taker_fee_rate': '0.003' })
+            })
+            if remaining <= 0:
+                break
+        self.pending.append(dict(order, type='done', reason='filled' if remaining <= 0 else 'canceled', remaining_size='{:.8f}'.format(max(remaining, 0))))
+
+
+class RecordedFeed():
+    """Replays recorded websocket messages in a loop. Subscription and heartbeat messages are skipped, the server sends its own"""
+
+    def __init__(self, recorded):
+        if isinstance(recorded, str):
+            with open(recorded) as f:
+                recorded = [ json.loads(line) for line in f if line.strip() ]
+        self.messages = [ message for message in recorded if message.get('type') not in ['subscriptions','heartbeat'] ]
+        if not self.messages:
+            raise Exception('The recording does not contain any feed messages')
+        self.position = 0
+        self.sequence = {}
+        for message in self.messages:
+            if 'sequence' in message:
+                self.sequence[message.get('product_id')] = message['sequence']
+
+    def message(self):
+        message = self.messages[self.position]
+        self.position = (self.position + 1) % len(self.messages)
+        return message
+
+    def heartbeat(self, product):
+        return { 'type': 'heartbeat', 'sequence': self.sequence.get(product, 0), 'last_trade_id': 0, 'product_id': product,
+                 'time': datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%fZ') }
+
+
+class LoadTest():
+    """
+    @info:
+    Runs a Client against a local FeedServer, started in its own process, and increases the message
+    rate step by step until the Client can no longer keep up. A step is sustained when
+        - the server sent at least delivery of the expected messages (rate * duration, less the injected gaps)
+        - the Client raised no processing errors since the previous step (Client.error_count did not grow)
+        - the queue of unprocessed messages (Client.messages) at the end of the step holds less than max_lag seconds worth of traffic
+
+    @use:
+    test = LoadTest(products=[ 'BTC-USD' ], rates=[ 100, 250, 500, 1000, 2000 ], duration=10)
+    test.run()
+    >>>
+           rate   sent  backlog   lag  errors  sustained
+        0   100   1000        0  0.00       0       True
+        1   250   2500        3  0.01       0       True
+        2   500   5000     3650  7.30       0      False
+        Highest sustained rate: 250 messages per second
+
+    @params:
+    products : Products subscribed to by the Client
+    rates    : Message rates (messages per second) to test, in increasing order
+    duration : Seconds spent at each rate
+    max_lag  : Seconds of traffic allowed to wait in the queue at the end of a step
+    delivery : Share of the expected messages the server must send for a step to count
+    ticker   : Boolean. subscribe the Client to the ticker channel
+    level2   : Boolean. subscribe the Client to the level2 channel
+    user     : Boolean. subscribe the Client to the user channel
+    seed     : Seed of the synthetic traffic
+    options  : Any other FeedServer parameter. Example recorded, gap_probability, burst_every, burst_size
+
+    @variables:
+    results  : DataFrame with one row per tested rate
+    capacity : Highest sustained rate, 0 when no rate was sustained
+    """
+
+    COLUMNS = ['rate','sent','backlog','lag','errors','sustained']
+
+    def __init__(self, products=['BTC-USD'], rates=[100, 250, 500, 1000, 2000, 4000], duration=10, max_lag=1.0, delivery=0.95,
+                 ticker=True, level2=True, user=False, seed=1, **options):
+        self.products = products
+        self.rates    = rates
+        self.duration = duration
+        self.max_lag  = max_lag
+        self.delivery = delivery
+        self.ticker   = ticker
+        self.level2   = level2
+        self.user     = user
+        self.seed     = seed
+        self.options  = options
+        self.results  = pd.DataFrame([], columns=self.COLUMNS)
+        self.capacity = 0
+
+    def gapped(self):
+        """Share of the traffic the server may drop as gaps, only ticker and l2update messages are dropped"""
+        if self.options.get('recorded') is not None:
+            return 1.0
+        weights = self.options.get('weights') or FeedServer.WEIGHTS
+        weights = { channel: weights.get(channel, 0) if subscribed else 0
+                    for channel, subscribed in [ ('ticker', self.ticker), ('level2', self.level2), ('user', self.user) ] }
+        return (weights['ticker'] + weights['level2']) / float(sum(weights.values()) or 1)
+
+    def wait(self, condition, timeout):
+        limit = time.time() + timeout
+        while not condition() and time.time() < limit:
+            time.sleep(0.1)
+        return condition()
+
+    def run(self):
+        server = FeedServer(products=self.products, rate=0, seed=self.seed, **self.options)
+        server.start(process=True)
+        client = Client(ticker=self.products if self.ticker else [], level2=self.products if self.level2 else [],
+                        user=self.user, url=server.url)
+        results = []
+        try:
+            client.open()
+            if not self.wait(lambda: server.connections > 0, 30):
+                raise Exception('The client did not connect to the feed server')
+            errors = 0
+            for rate in self.rates:
+                self.wait(lambda: len(client.messages) == 0, self.duration)
+                sent = server.sent
+                server.set_rate(rate)
+                time.sleep(self.duration)
+                backlog   = len(client.messages)
+                lag       = backlog / float(rate)
+                sent      = server.sent - sent
+                errors    = client.error_count - errors # includes the errors raised since the previous step, or since connecting
+                expected  = rate * self.duration * (1 - server.gap_probability * self.gapped())
+                sustained = lag <= self.max_lag and errors == 0 and sent >= self.delivery * expected
+                results.append({ 'rate': rate, 'sent': sent, 'backlog': backlog, 'lag': round(lag, 2), 'errors': errors, 'sustained': sustained })
+                print("{}: {} messages per second, sent {} of {:.0f}, backlog {} ({:.2f}s), errors {}".format(
+                    datetime.datetime.now(), rate, sent, expected, backlog, lag, errors))
+                if not sustained:
+                    break
+                errors = client.error_count
+                server.set_rate(0)
+        finally:
+            client.close()
+            server.stop()
+
+        self.results  = pd.DataFrame(results, columns=self.COLUMNS)
+        sustained     = self.results[ self.results['sustained'] ]['rate']
+        self.capacity = int(sustained.max()) if not sustained.empty else 0
+        print(self.results)
+        print("Highest sustained rate: {} messages per second".format(self.capacity))
+        return self.results
+
+
+if __name__ == '__main__':
+    LoadTest().run()
@@ -1,4 +1,5 @@
 import time, base64, hmac, hashlib, json, datetime
+from bisect import bisect_right
 import pandas as pd
 import numpy as np
 from random import randint
@@ -37,6 +38,10 @@ class Client():
     credentials: Dictionary with the API credentials needed to connect to Coinbase
     production : Boolean. if set to True the websocket will connect via url 'wss://ws-feed.pro.coinbase.com' 
                  else if set to False the websocket will connect via url 'wss://ws-feed-public.sandbox.pro.coinbase.com'
+    url        : Optional websocket url that overrides the production/sandbox url. Example the url of a local Simulator.FeedServer
+    journal    : Boolean. if set to True the level2 updates are journaled with periodic checkpoints so the orderbook can be rebuilt as of a past time, see self.orderbook_at
+    checkpoint_every: Number of level2 changes between journal checkpoints. Rebuilding a book applies at most this many changes
+    max_checkpoints : Number of journal checkpoints kept per product. Older checkpoints and their changes are dropped. None keeps the whole session
 
     @KEY METHODS:
     self.orderbook('BTC-USD')
@@ -46,6 +51,12 @@ class Client():
         7036.54   0.000000  bids
         7036.16   0.000000  asks
 
+    self.orderbook_at('BTC-USD', time='2018-10-12T10:15:00.000000Z')
+    >>> 
+        price     size      side
+        7036.54   1.250000  buy
+        7037.95   0.500000  sell
+
     self.ticker('BTC-USD')
     >>>
         {
@@ -72,6 +83,16 @@ class Client():
         1537465260  1537465260  6400.15  6402.96  6400.16  6402.95  20.687342
         1537465320  1537465320  6402.96  6405.00  6402.96  6405.00   4.263147
 
+    self.account('BTC-USD')
+    >>>
+        {
+            'balance': {'BTC': 0.5, 'USD': -3211.606},
+            'on_hold': {'BTC': 0.0, 'USD': 6400.0},
+            'filled' : {'BTC': 0.5, 'USD': 3202.0},
+            'fees'   : {'BTC': 0.0, 'USD': 9.606},
+            'matches': 2
+        }
+
 
     @variables:
     data   : dictionary data variable stores the consumable websocket messages post processing. structure
@@ -153,13 +174,15 @@ class Client():
                 DataFrame
                 Columns: [sequence, order_id, create_time, update_time, product_id, order_type, side, stop_price, price, size, USD, BTC, LTC, ETH, BCH, ETC, taker_fee_rate, status]
                 Index: []
+
+    exporter: instance of Export.Exporter while it is running, else None. New ticks and closed candles are handed to it as they are processed
     
     @methods:
     open() : Opens the connection and subscribes to the given channels for the given products
     close(): closes the connection to the websocket. This method does not clear out the data variable.
     """
     
-    def __init__(self, production=False, ticker=[], level2=[], user=[], ohlc=[], credentials=None ):
+    def __init__(self, production=False, ticker=[], level2=[], user=[], ohlc=[], credentials=None, url=None, journal=False, checkpoint_every=1000, max_checkpoints=100 ):
         self.url            = 'wss://ws-feed-public.sandbox.pro.coinbase.com'
         self.production     = production
         
@@ -168,11 +191,16 @@ class Client():
         self._user           = user
         self._ohlc           = ohlc
         self._credentials    = credentials
+        self._journal        = journal
+        self._checkpoint_every = checkpoint_every
+        self._max_checkpoints  = max_checkpoints
 
         self.updated_time   = time.time() + 30
         
         if self.production:  
             self.url        = 'wss://ws-feed.pro.coinbase.com'
+        if url:
+            self.url        = url
         self._subscription  = self.subscription( self._ticker, self._level2, self._user, self._credentials )
         self.data           = self.set_data( self._subscription, self._ohlc, self.production )
         self.messages       = []
@@ -181,6 +209,7 @@ class Client():
         self.terminated     = False
         self.error_count    = 0
         self.max_errors_allowed = 1000 
+        self.exporter       = None
 
         self.PRODUCTS       = ['BTC-USD','LTC-USD','ETH-USD','ETC-USD','LTC-BTC','ETH-BTC','ETC-BTC','BCH-USD','BCH-BTC','ZRX-USD','ZRX-BTC']
         self.accepted_message_type = ["error","ticker","snapshot","l2update","received","open","done","match","change","activate"] 
@@ -277,9 +306,13 @@ class Client():
     def process_tickers(self, message):
         if 'ticker' in self.data[message['product_id']]:
             self.data[message['product_id']]['ticker'].update( message )
+            if self.exporter:
+                self.exporter.tick( self.data[message['product_id']]['ticker'].live )
             if 'ohlc' in self.data[message['product_id']]:
                 for ohlc in self.data[message['product_id']]['ohlc']:
-                    self.data[message['product_id']]['ohlc'][ohlc].update( self.data[message['product_id']]['ticker'].live )
+                    closed = self.data[message['product_id']]['ohlc'][ohlc].update( self.data[message['product_id']]['ticker'].live )
+                    if closed and self.exporter:
+                        self.exporter.candle( message['product_id'], ohlc, closed )
     
     def process_orderbook(self, message):
         if 'orderbook' in self.data[message['product_id']]:
@@ -315,12 +348,23 @@ class Client():
     def orderbook(self, product):
         return self.data[product.upper()]['orderbook'].book
 
+    def orderbook_at(self, product, time=None, sequence=None):
+        """
+        Rebuilds the orderbook as of a past time (epoch, datetime or iso string) or journal sequence. Requires journal=True.
+        The level2 messages carry no exchange sequence, so sequence is the journal's count of recorded messages, see Journal
+        """
+        return self.data[product.upper()]['orderbook'].as_of(time, sequence).book
+
     def ticker(self, product):
         return self.data[product.upper()]['ticker'].live
 
     def ohlc(self, product, ohlc):
         return self.data[product.upper()]['ohlc'][ohlc].candles
     
+    def account(self, product=None):
+        """Running balance, on hold, filled and fee totals of the user channel for the account, or for the given product"""
+        return self.data['user'].accounting.totals(product.upper() if product else None)
+
     def orders(self, ids='*'):
         orders  = self.data['user'].orders
         columns = self.data['user'].columns
@@ -343,7 +387,7 @@ class Client():
                         data[ product ][ 'ticker' ]    = Ticker()
                 if channel['name'] == 'level2':
                     for product in channel['product_ids']:
-                        data[ product ][ 'orderbook' ] = OrderBookManagement()
+                        data[ product ][ 'orderbook' ] = OrderBookManagement( self._journal, self._checkpoint_every, self._max_checkpoints )
             elif channel == 'user':
                 data[ 'user' ] = OrderManagement()
         for candles in OHLC_:
@@ -477,13 +521,16 @@ class OHLC():
         self.candles.sort_index(inplace=True)
             
     def update(self, ticker):
+        """Updates the last candle with the ticker, or opens a new one. Returns the candle that was closed by the ticker as a dict, else None"""
         if type(ticker) != pd.Series:
             ticker = pd.Series(ticker)
             
         try:
+            closed    = None
             candle    = self.candles[[ 'time', 'low', 'high', 'open', 'close', 'volume' ]].iloc[-1]
             next_time = candle.time + self.granularity
             if ticker.time >= next_time:
+                closed       = candle.to_dict()
                 candle.time  = next_time
                 candle.open  = ticker.price
                 candle.high  = ticker.price
@@ -497,10 +544,11 @@ class OHLC():
                 candle.volume+= ticker.last_size
             self.candles = self.candles.append(candle, ignore_index=True).drop_duplicates('time','last')
             self.candles.index = self.candles.time.tolist()
+            return closed
         except ValueError as e:
             if e == 'cannot reindex from a duplicate axis':
                 self.candles = self.candles.drop_duplicates(subset='time', keep='last')
-                self.update(ticker)
+                return self.update(ticker)
         except Exception as e:
             print("Error in {} {} ohlc update".format(self.product, self.increment))
             raise Exception(e)
@@ -512,10 +560,11 @@ class OrderManagement():
         self.records         = []
         self.ready_to_process= []
         self.currencies      = ['USD','BTC','LTC','ETH','BCH','ETC','ZRX']
-        self.numeric         = ['funds','limit_price', 'new_funds', 'old_funds','new_size','old_size','currency_on_hold','on_hold','price','remaining_size','size','stop_price','taker_fee_rate' ]
+        self.numeric         = ['funds','limit_price', 'new_funds', 'old_funds','new_size','old_size','currency_on_hold','on_hold','price','remaining_size','size','stop_price','taker_fee_rate','maker_fee_rate' ]
         self.non_numeric     = ['maker_order_id','maker_user_id','user_id','order_id','order_type','product_id','reason','time','trade_id','taker_order_id','type','stop_type']
         self.columns         = ['time','order_id','create_time','update_time','product_id','order_type','side','stop_price','price','size','currency_on_hold','on_hold','taker_fee_rate','status'] + self.currencies
         self.orders          = pd.DataFrame([], columns=self.columns)
+        self.accounting      = Accounting(self.currencies)
         
     def prep(self, order):
         """Method used to create the update dict to process"""
@@ -593,6 +642,7 @@ class OrderManagement():
         pairs           = order['product_id'].split('-')
         size            = order['size']
         price           = order.price
+        fee_rate        = order.maker_fee_rate if maker else order.taker_fee_rate # only the match message carries the fee rate
         order.order_id  = order.maker_order_id if maker else order.taker_order_id
         existing        = self.find_order(order.order_id)
 
@@ -608,7 +658,7 @@ class OrderManagement():
             
             multiplier      = 1 if order.side == 'sell' else -1
             order[pairs[0]]+= (-(multiplier) * size)
-            order[pairs[1]]+= (multiplier*((price * size) + (-(multiplier)*(price * size * order.taker_fee_rate))))
+            order[pairs[1]]+= (multiplier*((price * size) + (-(multiplier)*(price * size * fee_rate))))
             order.on_hold  = (order.price * order['size']) + order[pairs[1]] if order.side == 'buy' else order['size'] + order[pairs[0]]
             order.on_hold  = 0 if order.on_hold<0 else order.on_hold
             return order[self.columns]  
@@ -624,6 +674,20 @@ class OrderManagement():
             order.status = order.reason
             return order[self.columns]
 
+    def change(self, order):
+        existing = self.find_order(order.order_id)
+        if existing.empty:
+            return pd.Series()
+        else:
+            existing.update_time = order.update_time
+            existing.price       = order.price if order.price else existing.price
+            if order.new_funds:
+                existing.on_hold = order.new_funds
+            else:
+                existing['size'] = order.new_size
+                existing.on_hold = existing.price * order.new_size if existing.side == 'buy' else order.new_size
+            return existing[self.columns]
+
     def update(self, original_order): # 'received','open','activate','match','done','change'
         try:
             order  = self.prep(original_order)
@@ -643,10 +707,15 @@ class OrderManagement():
                 
             elif order.type == 'done':
                 update = self.done(order)
+
+            elif order.type == 'change':
+                update = self.change(order)
                 
             if update.empty:
                 return original_order
             else:
+                if update.status in ['canceled','filled']:
+                    update.on_hold = 0.0
                 old_orders  = self.orders
                 new_order   = pd.DataFrame([update.to_dict()])#.set_index('time',False)
                 self.orders = pd.concat( [ old_orders, new_order ], sort=True, ignore_index=True )
@@ -654,19 +723,101 @@ class OrderManagement():
                 
             self.orders.fillna(0,inplace=True)
             self.orders.drop_duplicates(subset=['order_id','time'], keep='last', inplace=True)
-            self.orders.loc[ self.orders.status.isin(['canceled','filled']), 'on_hold' ] = 0.0
+            # applied last, a message that failed above is retried by the Client and must not be counted twice
+            self.accounting.update(order, update)
         except Exception as e:
             print("Error updating orders. Error message: {}\n{}\n".format(e, order))
             return original_order
 
             
 
+class Accounting():
+    """
+    @info:
+    Running totals of the user channel kept for the whole account and for each product. Every order
+    update is applied in O(1), so the totals can be read on every tick without aggregating the
+    orders DataFrame of OrderManagement.
+
+    @variables:
+    balance : net change of each currency from the matches, fees included. Same values as the sum of the currency columns of OrderManagement.orders
+    on_hold : funds of each currency held by the open orders. The hold is set when an order is opened, activated or changed,
+              reduced by every fill (price * size for a buy, size for a sell) and released when the order is done
+    filled  : filled size (base currency) and filled funds (quote currency) of the matches
+    fees    : fees paid in each currency
+    matches : number of matches
+    """
+
+    def __init__(self, currencies):
+        self.currencies = currencies
+        self.account    = self.empty(currencies)
+        self.products   = {}
+        self.holds      = {} # order_id: [ product, currency, on_hold ] of the open orders
+
+    def empty(self, currencies):
+        return { 'balance': dict.fromkeys(currencies, 0.0), 'on_hold': dict.fromkeys(currencies, 0.0),
+                 'filled' : dict.fromkeys(currencies, 0.0), 'fees'   : dict.fromkeys(currencies, 0.0), 'matches': 0 }
+
+    def add(self, totals, key, currency, value):
+        totals[key][currency] = totals[key].get(currency, 0.0) + value
+
+    def apply(self, product, key, currency, value):
+        self.add(self.account, key, currency, value)
+        self.add(self.products[product], key, currency, value)
+
+    def hold(self, order_id, product, currency, on_hold):
+        """Replaces the funds held by an order"""
+        if order_id in self.holds:
+            held_product, held_currency, held = self.holds.pop(order_id)
+            self.apply(held_product, 'on_hold', held_currency, -held)
+        if on_hold > 0:
+            self.holds[order_id] = [product, currency, on_hold]
+            self.apply(product, 'on_hold', currency, on_hold)
+
+    def update(self, order, row):
+        """Applies an order update. order is the prepared message (the fee rate is read from it), row the resulting row of the orders DataFrame"""
+        product = row['product_id']
+        if product not in self.products:
+            self.products[product] = self.empty(product.split('-'))
+
+        if order.type == 'match':
+            base, quote = product.split('-')
+            size, price = order['size'], order.price
+            multiplier  = 1 if row.side == 'sell' else -1
+            fee_rate    = order.maker_fee_rate if order.maker_user_id == order.user_id else order.taker_fee_rate
+            fee         = price * size * fee_rate
+            self.apply(product, 'balance', base,  -(multiplier) * size)
+            self.apply(product, 'balance', quote, multiplier * ((price * size) + (-(multiplier) * fee)))
+            self.apply(product, 'filled',  base,  size)
+            self.apply(product, 'filled',  quote, price * size)
+            self.apply(product, 'fees',    quote, fee)
+            self.account['matches']           += 1
+            self.products[product]['matches'] += 1
+
+            if row.order_id in self.holds:
+                _, currency, on_hold = self.holds[row.order_id]
+                self.hold(row.order_id, product, currency, on_hold - (price * size if row.side == 'buy' else size))
+
+        if order.type == 'done' or row.status in ['canceled','filled']:
+            self.hold(row.order_id, product, row.currency_on_hold, 0.0)
+        elif order.type in ['open','activate','change']:
+            self.hold(row.order_id, product, row.currency_on_hold, row.on_hold)
+
+    def totals(self, product=None):
+        """Returns a copy of the totals of the account, or of the given product"""
+        if product is None:
+            totals = self.account
+        else:
+            totals = self.products.get(product, None) or self.empty(product.split('-'))
+        return { key: value.copy() if type(value) == dict else value for key, value in totals.items() }
+
+
 class OrderBookManagement():
-    def __init__(self):
+    def __init__(self, journal=False, checkpoint_every=1000, max_checkpoints=100):
         self.book              = pd.DataFrame([[0,0,'-']],columns=['price','size','side']).set_index('price')
         self.snapshot_received = False
         self.backlog           = []
         self.errors            = []
+        self.journal           = Journal(checkpoint_every, max_checkpoints) if journal else None
 
     def bids(self, remove_zeros=True):
         return self.book[ (self.book['side']=='bids') & (self.book['size'] > (0 if remove_zeros else -1)) ].sort_index(ascending=False).reset_index()[['price','size']]
@@ -674,6 +825,24 @@ class OrderBookManagement():
     def asks(self, remove_zeros=True):
         return self.book[ (self.book['side']=='asks') & (self.book['size'] > (0 if remove_zeros else -1)) ].sort_index(ascending=True).reset_index()[['price','size']]
 
+    def top(self, depth=10):
+        """Returns the best depth price levels of each side with a size greater than 0. Columns [side, level, price, size]"""
+        book = self.book
+        book = book if 'price' in book.columns else book.reset_index()
+        book = book[ book['size'] > 0 ]
+        bids = book[ book['side'].isin(['buy','bids']) ].nlargest(depth, 'price')
+        asks = book[ book['side'].isin(['sell','asks']) ].nsmallest(depth, 'price')
+        return pd.concat([
+                   pd.DataFrame({ 'side': 'bids', 'level': range(len(bids)), 'price': bids['price'].values, 'size': bids['size'].values }),
+                   pd.DataFrame({ 'side': 'asks', 'level': range(len(asks)), 'price': asks['price'].values, 'size': asks['size'].values })
+               ], ignore_index=True)[['side','level','price','size']]
+
+    def as_of(self, time=None, sequence=None):
+        """Returns an OrderBookManagement instance with the book as of the given time or sequence, rebuilt from the journal"""
+        if not self.journal:
+            raise Exception("The orderbook is not journaled. Create the Client with journal=True")
+        return self.journal.as_of(time, sequence)
+
     def l2update(self, orders):
         orders = pd.DataFrame(orders['changes'], columns=['side','price','size']).apply(pd.to_numeric, **{'errors':'ignore'})
         self.book = pd.concat([self.book, orders]).reset_index(drop=True).drop_duplicates(subset='price', keep='last')[['price','size','side']]
@@ -697,6 +866,123 @@ class OrderBookManagement():
                     self.backlog += message['changes']
             elif message['type'] == 'snapshot':
                 self.snapshot(message)
+            if self.journal:
+                self.journal.record(message)
         except Exception as e:
             raise Exception("Error processing {} OrderBook update: Message -> {}".format(message['product_id'], e))
-      
\ No newline at end of file
+
+
+class Journal():
+    """
+    @info:
+    Records the level2 messages of a product as a list of deltas (time, sequence, side, price, size)
+    and takes a compact checkpoint of the book (dictionaries of price: size) every checkpoint_every
+    deltas and on every snapshot. A book is rebuilt by loading the last checkpoint before the
+    requested time or sequence and applying only the deltas recorded after it, so the cost is
+    bounded by checkpoint_every and not by the length of the session. Only the last max_checkpoints
+    checkpoints and the deltas after the oldest of them are kept, which bounds the memory used.
+
+    time    : the exchange time of the message. Snapshots have no time, their checkpoint is stamped with the
+              time of the first delta that follows. The local time is used only for messages without a time
+    sequence: the journal's count of recorded messages, starting at 1. Level2 messages have no exchange sequence
+    """
+
+    def __init__(self, checkpoint_every=1000, max_checkpoints=100):
+        self.checkpoint_every = checkpoint_every
+        self.max_checkpoints  = max_checkpoints
+        self.bids             = {}
+        self.asks             = {}
+        self.deltas           = []
+        self.dropped          = 0  # number of deltas dropped from the front of self.deltas
+        self.checkpoints      = [] # (time, sequence, position of the next delta, bids, asks)
+        self.times            = []
+        self.sequences        = []
+        self.time             = 0.0
+        self.sequence         = 0
+        self.pending          = False # the last checkpoint is a snapshot waiting for the time of the first delta
+
+    def timestamp(self, value=None):
+        """Converts an epoch, datetime or iso string to an epoch. None returns the current time"""
+        if value is None:
+            return time.time()
+        if isinstance(value, datetime.datetime):
+            return value.timestamp() if value.tzinfo else value.replace(tzinfo=datetime.timezone.utc).timestamp()
+        if isinstance(value, str):
+            try:
+                return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=datetime.timezone.utc).timestamp()
+            except ValueError:
+                return pd.to_datetime(value, utc=True).timestamp()
+        return float(value)
+
+    def checkpoint(self):
+        self.checkpoints.append(( self.time, self.sequence, self.dropped + len(self.deltas), self.bids.copy(), self.asks.copy() ))
+        self.times.append(self.time)
+        self.sequences.append(self.sequence)
+        if self.max_checkpoints and len(self.checkpoints) > self.max_checkpoints:
+            del self.checkpoints[0], self.times[0], self.sequences[0]
+            position      = self.checkpoints[0][2]
+            del self.deltas[:position - self.dropped]
+            self.dropped  = position
+
+    def stamp(self):
+        """Stamps the pending snapshot checkpoint with the current time of the journal"""
+        self.checkpoints[-1] = ( self.time, ) + self.checkpoints[-1][1:]
+        self.times[-1]       = self.time
+        self.pending         = False
+
+    def record(self, message):
+        self.sequence += 1
+        if 'time' in message:
+            # times are kept increasing so the checkpoints can be searched with bisect
+            self.time = max(self.timestamp(message['time']), self.time)
+        if message['type'] == 'snapshot':
+            self.bids    = { float(price): float(size) for price, size in message['bids'][:250] }
+            self.asks    = { float(price): float(size) for price, size in message['asks'][:250] }
+            self.checkpoint()
+            self.pending = 'time' not in message
+        elif message['type'] == 'l2update' and self.checkpoints:
+            if 'time' not in message:
+                self.time = max(self.timestamp(), self.time)
+            if self.pending:
+                self.stamp()
+            for side, price, size in message['changes']:
+                price, size = float(price), float(size)
+                self.deltas.append(( self.time, self.sequence, side, price, size ))
+                self.apply(self.bids if side == 'buy' else self.asks, price, size)
+            if self.dropped + len(self.deltas) - self.checkpoints[-1][2] >= self.checkpoint_every:
+                self.checkpoint()
+
+    def apply(self, book, price, size):
+        if size:
+            book[price] = size
+        else:
+            book.pop(price, None)
+
+    def as_of(self, time=None, sequence=None):
+        if not self.checkpoints:
+            raise Exception("The journal has not received a snapshot yet")
+        if sequence is not None:
+            if sequence < self.sequences[0] or sequence > self.sequence:
+                raise Exception("Sequence {} is outside the journal, which holds sequences {} to {}".format(sequence, self.sequences[0], self.sequence))
+            target, key, field = sequence, self.sequences, 1
+        else:
+            target, key, field = self.timestamp(time), self.times, 0
+        i = bisect_right(key, target) - 1
+        if i < 0:
+            raise Exception("The journal has no orderbook before {}. The oldest checkpoint is at {}".format(time, self.times[0]))
+
+        _, _, position, bids, asks = self.checkpoints[i]
+        end        = self.checkpoints[i + 1][2] if i + 1 < len(self.checkpoints) else self.dropped + len(self.deltas)
+        bids, asks = bids.copy(), asks.copy()
+        for delta in self.deltas[position - self.dropped:end - self.dropped]:
+            if delta[field] > target:
+                break
+            self.apply(bids if delta[2] == 'buy' else asks, delta[3], delta[4])
+
+        orderbook = OrderBookManagement()
+        orderbook.book = pd.concat([
+                             pd.DataFrame( sorted(bids.items(), reverse=True), columns=['price','size'] ).assign(side='buy'),
+                             pd.DataFrame( sorted(asks.items()),               columns=['price','size'] ).assign(side='sell')
+                         ], ignore_index=True)[['price','size','side']]
+        orderbook.snapshot_received = True
+        return orderbook
@@ -1 +1,3 @@
-from Websocket import Client, OrderManagement, OrderBookManagement
\ No newline at end of file
+from Websocket import Client, OrderManagement, OrderBookManagement
+from Simulator import FeedServer, LoadTest
+from Export import Exporter
\ No newline at end of file
@@ -0,0 +1,55 @@
+from Websocket import OrderManagement
+
+ORDER_ID = 'd50ec984-77a8-460a-b958-66f114b0de9b'
+OTHER_ID = '1f2e3d4c-5b6a-4978-8695-a4b3c2d1e0f9'
+
+def message(type, second, **fields):
+    return dict({ 'type': type, 'product_id': 'BTC-USD', 'order_id': ORDER_ID, 'side': 'buy', 'price': '6404.00',
+                  'time': '2018-10-12T10:15:{:02d}.000000Z'.format(second) }, **fields)
+
+def match(second, size, maker, fee_rate):
+    fee = { 'maker_fee_rate': fee_rate } if maker else { 'taker_fee_rate': fee_rate }
+    return dict({ 'type': 'match', 'trade_id': second, 'time': '2018-10-12T10:15:{:02d}.000000Z'.format(second), 'product_id': 'BTC-USD',
+                  'maker_order_id': ORDER_ID if maker else OTHER_ID, 'taker_order_id': OTHER_ID if maker else ORDER_ID,
+                  'size': size, 'price': '6404.00', 'side': 'buy' if maker else 'sell', 'user_id': 'user',
+                  'maker_user_id': 'user' if maker else 'counterparty' }, **fee)
+
+def process(messages):
+    orders = OrderManagement()
+    for m in messages:
+        assert orders.update(m) is None
+    return orders
+
+def test_taker_match_fee():
+    orders = process([ message('received', 0, size='1.00', order_type='limit'), match(1, '0.50', False, '0.003') ])
+    totals = orders.accounting.totals('BTC-USD')
+    fee    = 6404.0 * 0.5 * 0.003
+    assert abs(totals['fees']['USD'] - fee) < 1e-9
+    assert abs(totals['filled']['USD'] - 3202.0) < 1e-9
+    assert abs(totals['balance']['USD'] - (-3202.0 - fee)) < 1e-9
+    assert abs(totals['balance']['BTC'] - 0.5) < 1e-9
+    assert totals['matches'] == 1
+    # the running totals agree with the orders DataFrame
+    assert abs(orders.orders['USD'].sum() - totals['balance']['USD']) < 1e-9
+
+def test_maker_match_fee():
+    orders = process([ message('received', 0, size='1.00', order_type='limit'), message('open', 1, remaining_size='1.00'),
+                       match(2, '0.50', True, '0.0015') ])
+    totals = orders.accounting.totals()
+    fee    = 6404.0 * 0.5 * 0.0015
+    assert abs(totals['fees']['USD'] - fee) < 1e-9
+    assert abs(totals['balance']['USD'] - (-3202.0 - fee)) < 1e-9
+    assert abs(orders.orders['USD'].sum() - totals['balance']['USD']) < 1e-9
+
+def test_partial_maker_fill_on_hold():
+    orders = process([ message('received', 0, size='1.00', order_type='limit'), match(1, '0.50', False, '0.003'),
+                       message('open', 2, remaining_size='0.50') ])
+    assert abs(orders.accounting.totals('BTC-USD')['on_hold']['USD'] - 3202.0) < 1e-9
+
+    orders.update(match(3, '0.25', True, '0.0015'))
+    assert abs(orders.accounting.totals('BTC-USD')['on_hold']['USD'] - 1601.0) < 1e-9
+    assert abs(orders.accounting.totals()['on_hold']['USD'] - 1601.0) < 1e-9
+
+    orders.update(message('done', 4, reason='canceled', remaining_size='0.25'))
+    assert orders.accounting.totals('BTC-USD')['on_hold']['USD'] == 0.0
+    assert orders.accounting.holds == {}
@@ -0,0 +1,76 @@
+from random import Random
+import pytest
+from Websocket import Journal
+
+def feed(deltas=600, seed=1):
+    """A snapshot without a time, like the exchange sends it, followed by timed l2updates"""
+    rng      = Random(seed)
+    messages = [ { 'type': 'snapshot', 'product_id': 'BTC-USD',
+                   'bids': [ [ str(100 - level), str(level) ] for level in range(1, 11) ],
+                   'asks': [ [ str(100 + level), str(level) ] for level in range(1, 11) ] } ]
+    for i in range(deltas):
+        changes = [ [ rng.choice(['buy','sell']), str(rng.randint(80, 120)), str(rng.choice([0, 1, 2.5])) ] for _ in range(rng.randint(1, 3)) ]
+        messages.append({ 'type': 'l2update', 'product_id': 'BTC-USD', 'changes': changes,
+                          'time': '2018-10-12T10:{:02d}:{:02d}.000000Z'.format(i // 60, i % 60) })
+    return messages
+
+def replay(messages, sequence):
+    """Rebuilds the book by applying every message up to the journal sequence (1 based)"""
+    book = { 'buy': {}, 'sell': {} }
+    for message in messages[:sequence]:
+        if message['type'] == 'snapshot':
+            book = { 'buy' : { float(price): float(size) for price, size in message['bids'] },
+                     'sell': { float(price): float(size) for price, size in message['asks'] } }
+        else:
+            for side, price, size in message['changes']:
+                if float(size):
+                    book[side][float(price)] = float(size)
+                else:
+                    book[side].pop(float(price), None)
+    return book
+
+def levels(orderbook):
+    book = orderbook.book
+    return { side: dict(zip(book[ book.side == side ].price, book[ book.side == side ]['size'])) for side in ['buy','sell'] }
+
+def record(messages, **options):
+    journal = Journal(**options)
+    for message in messages:
+        journal.record(message)
+    return journal
+
+def test_as_of_sequence_matches_replay():
+    messages = feed()
+    journal  = record(messages, checkpoint_every=25, max_checkpoints=None)
+    # around the first checkpoints, in between checkpoints and at the end of the journal
+    for sequence in [1, 2, 3, 10, 11, 12, 13, 150, 299, 300, 301, len(messages)]:
+        assert levels(journal.as_of(sequence=sequence)) == replay(messages, sequence)
+
+def test_as_of_time_uses_exchange_time_of_first_delta_for_snapshot():
+    messages = feed()
+    journal  = record(messages, checkpoint_every=25, max_checkpoints=None)
+    # the snapshot checkpoint is stamped with the time of the first delta, so a query at that time includes the delta
+    assert journal.times[0] == journal.timestamp(messages[1]['time'])
+    assert levels(journal.as_of(time=messages[1]['time'])) == replay(messages, 2)
+    assert levels(journal.as_of(time='2018-10-12T10:05:17.000000Z')) == replay(messages, 2 + 5 * 60 + 17)
+    with pytest.raises(Exception):
+        journal.as_of(time='2018-10-12T09:59:59.000000Z')
+
+def test_eviction_keeps_replay_equivalence():
+    messages = feed()
+    journal  = record(messages, checkpoint_every=20, max_checkpoints=4)
+    assert len(journal.checkpoints) == 4
+    assert journal.dropped + len(journal.deltas) == sum(len(m['changes']) for m in messages[1:])
+    assert len(journal.deltas) <= 5 * 20 + 3
+    first = journal.sequences[0]
+    for sequence in [first, first + 1, first + 7, journal.sequences[2], journal.sequences[2] + 1, len(messages)]:
+        assert levels(journal.as_of(sequence=sequence)) == replay(messages, sequence)
+    time = journal.deltas[-1][0]
+    assert levels(journal.as_of(time=time)) == replay(messages, len(messages))
+
+def test_out_of_range_sequence_raises():
+    messages = feed()
+    journal  = record(messages, checkpoint_every=20, max_checkpoints=4)
+    for sequence in [1, journal.sequences[0] - 1, len(messages) + 1, 6555468983]:
+        with pytest.raises(Exception):
+            journal.as_of(sequence=sequence)